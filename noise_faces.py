@@ -9,13 +9,12 @@ import numpy as np
 import json
 import multiprocessing as mp 
 import argparse
-
-# basic cv tools
-import cv2 as cv
-from PIL import Image, ImageOps
+import queue
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 
 # noise generators
-from noise_generators_camera import poor_focus, dark_noise, shot_noise, salt_and_pepper, under_expose, over_expose
+from noise_generators_camera import poor_focus, dark_noise, shot_noise, salt_and_pepper, under_expose, over_expose, seed_noise, image_read, image_write
 from noise_generators_environment import point_source, point_shadow, streak_source, streak_shadow, pipe_source, pipe_shadow
 
 
@@ -23,40 +22,41 @@ from noise_generators_environment import point_source, point_shadow, streak_sour
 MODE = ['NOISE', 'RM']
 NOISE = ['ALL', 'CAM', 'ENV']
 
+# noise sources, camera and environmental
+_SENSOR_NOISES = (poor_focus, dark_noise, shot_noise, salt_and_pepper)
+_EXPOSURES = (under_expose, over_expose)
+_ENVIRONMENTS = (point_source, point_shadow, streak_source, streak_shadow, pipe_source, pipe_shadow)
+_ALL_NOISES = _SENSOR_NOISES + _EXPOSURES + _ENVIRONMENTS
+
+# noise sources by category, shared by the producer and the workers
+_NOISES = {'camera': _SENSOR_NOISES + _EXPOSURES, 'env': _ENVIRONMENTS}
+
+# noise function lookup so worker tasks only carry the function name
+NOISE_FUNCTIONS = {noise.__name__: noise for noise in _ALL_NOISES}
+
+# camera noises which default to PIL inputs and must be flagged for numpy arrays
+PIL_NOISES = frozenset([dark_noise, shot_noise, salt_and_pepper])
+
+# directories already created by this process
+_CREATED_DIRS = set()
 
-def image_write(noise_im, im_dir, im_name, noise, counter = -1):
+# per-process worker state, populated once by _init_worker
+_W = {}
+
+
+def make_dir(path):
     """
-    The image_write function automates writing the noise-augmented image to an appropriate directory. 
-    
-    :param noise_im: the noise-augmented image
-    :type noise_im: numpy array
-    
-    :param im_dir: the path to the image write directory
-    :type im_dir: string
+    The make_dir function creates a directory (and its parents) once per process.
+    Created paths are memoized so repeated calls do not hit the filesystem.
     
-    :param im_name: the name of the image to be writteny
-    :type im_name: string
-    
-    :param noise: the noise augmentation function
-    :type noise: function pointer
-    
-    :param counter: a counter to append to the image for automation
-    :type counter: integer, optional
-    
-    :return: the noise-augmented image
-    :rtype: numpy array
+    :param path: the directory to be created
+    :type path: string
     """
     
-    # convert image to PIL format
-    noise_im = Image.fromarray(noise_im)
-    
-    # if a counter is specified, format it accordingly
-    if counter >= 0: count = '_'+str(counter).zfill(4)
-    else: count = ''
-    
-    # generate the path and write the image to disk
-    write_path = im_dir + im_name + '_' + noise.__name__ + count + '.png'
-    noise_im.save(write_path)
+    # only touch the filesystem for directories not seen before
+    if path not in _CREATED_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _CREATED_DIRS.add(path)
 
 
 def parse_args():
@@ -91,9 +91,35 @@ def parse_args():
     # return the parsed dictionary
     return args
 
+def _init_worker(camera_flag = True, environment_flag = True):
+    """
+    The _init_worker function seeds the noise generator and caches the enabled noise functions once per process, it is used as the pool initializer.
+    
+    :param camera_flag: flag whether camera noises are to be used
+    :type camera_flag: boolean
+    
+    :param environment_flag: flag whether environment noises are to be used
+    :type environment_flag: boolean
+    """
+    
+    # total noise sources
+    noises = ()
+    if camera_flag: noises += _NOISES['camera']
+    if environment_flag: noises += _NOISES['env']
+    
+    # give this process its own noise generator, forked workers would otherwise share the parent's state
+    seed_noise()
+    
+    # cache the integer-indexed noise table and its name lookup for this process
+    _W['flags'] = (camera_flag, environment_flag)
+    _W['noises'] = noises
+    _W['functions'] = {noise.__name__: noise for noise in noises}
+
+
 def noise_helper(im_dir, write_loc, camera_flag = True, environment_flag = True):
     """
-    The noise_helper function breaks out the directory noise-augmentation logic for multiprocessin.
+    The noise_helper function scans a data directory and generates the image-level noise-augmentation tasks for multiprocessing.
+    The write directories are created up front so the workers only need to read, noisify and write.
     
     :param im_dir: the directory of the where the data is
     :type im_dir: string
@@ -106,73 +132,292 @@ def noise_helper(im_dir, write_loc, camera_flag = True, environment_flag = True)
     
     :param environment_flag: flag whether environment noises are to be used
     :type environment_flag: boolean
+    
+    :return: generator of (image path, write directory, noise function name) tasks
+    :rtype: generator
     """
     
-    features = {}
-
-    # camera noises
-    sensor_noises = [blur, gaussian, poisson, salt_and_pepper]
-    exposures = [under_expose, over_expose]
-
-    # environmental noises
-    environments = [point_source, point_shadow, streak_source, streak_shadow, pipe_source, pipe_shadow]
-
-    # total noise sources
-    noises = []
-    if camera_flag: noises += sensor_noises + exposures
-    if environment_flag: noises += environments
+    # total noise sources, cached per process rather than rebuilt per directory
+    if _W.get('flags') != (camera_flag, environment_flag):
+        _init_worker(camera_flag, environment_flag)
+    noises = _W['noises']
 
     # setup the directory read and write paths
-    loc_dir = os.path.join(person_data, im_dir)
-    write_dir = os.path.join(write_loc, im_dir)
+    loc_dir = im_dir
+    write_dir = write_loc
 
     # verify we have data first
     if os.path.isdir(loc_dir):
 
-        # make the participant write directory if does not exist
-        if not os.path.exists(write_dir):
-            os.makedirs(write_dir)
-
-        # make the noise write subdirectory if does not exist
+        # make the noise write subdirectories, this also creates the participant directory
         for noisify in noises:
-            if not os.path.exists(os.path.join(write_dir, noisify.__name__)):
-                os.makedirs(os.path.join(write_dir, noisify.__name__))        
+            make_dir(os.path.join(write_dir, noisify.__name__))
 
-        # set the local directory
-        os.chdir(loc_dir)
-        
-        # get the images
-        images = glob("*.png")
+        # get the images in a single directory pass, no chdir so concurrent callers are safe
+        with os.scandir(loc_dir) as entries:
+            images = [entry.name for entry in entries if entry.is_file(follow_symlinks=False) and entry.name.endswith('.png')]
         print('Noisifying', loc_dir, len(images))
         
-        # iterate through images and noisify them
+        # iterate through images and assign their noises
         for im in images:       
             
-            # read in the image
-            im_path = os.path.join(loc_dir, im)
-            image = Image.open(im_path, 'r')
+            # select the noise-augmentation function, index zero leaves the image clean
+            k = random.randrange(len(noises)+1)
+            if k == 0:
+                continue
+            noisify = noises[k-1]
             
-            # apply the noise-augmentation function
-            noisify = random.choice(['none']+noises)
+            yield (os.path.join(loc_dir, im), os.path.join(write_dir, noisify.__name__), noisify.__name__)
 
-            # encofrce there is at least one valie noise
-            if noisify != 'none':
 
-                # environmental noises are CV operations
-                if noisify in environments:
-                    image = np.asarray(image)
-                
-                # apply the noise augmentation
-                im_noisy = noisify(image)
-                
-                # write the image
-                im_name = im.split(".")
-                noise_image_write(im_noisy, gen_os_path(write_dir, noisify.__name__), im_name[0], noisify)
+def _noisify(noise_name, image):
+    """
+    The _noisify function applies a cached noise function to a numpy image, flagging the PIL-based noises as needed.
+    
+    :param noise_name: the name of the noise augmentation function
+    :type noise_name: string
+    
+    :param image: the image to be noise-augmented
+    :type image: numpy array
+    
+    :return: the noise-augmented image
+    :rtype: numpy array
+    """
+    
+    # look up the noise function
+    noisify = _W['functions'][noise_name]
+    
+    # apply the noise augmentation, the image stays a numpy array throughout
+    if noisify in PIL_NOISES:
+        return noisify(image, cv_image = True)
+    return noisify(image)
+
+
+def _apply_one(task):
+    """
+    The _apply_one function is the inline worker, it noise-augments and writes a single image.
+    
+    :param task: the (image path, write directory, noise function name) task from noise_helper
+    :type task: tuple
+    """
+    
+    # unpack the task
+    im_path, write_dir, noise_name = task
+    
+    # read in the image as a uint8 numpy array and apply the noise
+    image = image_read(im_path)
+    im_noisy = _noisify(noise_name, image)
+    
+    # write the image
+    im_name = os.path.basename(im_path).split(".")
+    image_write(im_noisy, write_dir, im_name[0], NOISE_FUNCTIONS[noise_name])
+
+
+def _attach(name):
+    """
+    The _attach function attaches a pooled shared memory segment once per worker process and caches it.
+    
+    :param name: the name of the shared memory segment
+    :type name: string
+    
+    :return: the attached shared memory segment
+    :rtype: SharedMemory
+    """
+    
+    # attach on first use, later tasks reuse the mapping
+    segments = _W.setdefault('segments', {})
+    if name not in segments:
+        segments[name] = shared_memory.SharedMemory(name=name)
+    return segments[name]
+
+
+def _release(buffers, pooled, slot, free):
+    """
+    The _release function returns an in-flight slot to the free-list, unlinking the temporary blocks of oversized images.
+    
+    :param buffers: the input and output shared memory blocks
+    :type buffers: list
+    
+    :param pooled: flag whether the blocks are pooled segments or temporary blocks
+    :type pooled: boolean
+    
+    :param slot: the index of the in-flight slot
+    :type slot: integer
+    
+    :param free: the free-list of slot indices
+    :type free: queue
+    """
+    
+    # temporary blocks are only used once
+    if not pooled:
+        for shm in buffers:
+            shm.close()
+            shm.unlink()
+    
+    # hand the slot back to the master
+    free.put(slot)
 
 
-def noisify_data(data_root, write_root = '', camera_flag = True, environment_flag = True):
+def _transform_shared(noise_name, in_name, out_name, shape, pooled = True):
+    """
+    The _transform_shared function is the process worker, it noise-augments an image held in shared memory.
+    The decoded image is attached rather than pickled and the result is written into a second shared block.
+    
+    :param noise_name: the name of the noise augmentation function
+    :type noise_name: string
+    
+    :param in_name: the name of the shared memory block holding the decoded image
+    :type in_name: string
+    
+    :param out_name: the name of the shared memory block receiving the noise-augmented image
+    :type out_name: string
+    
+    :param shape: the decoded image shape
+    :type shape: tuple
+    
+    :param pooled: flag whether the blocks are pooled segments, which stay attached, or temporary blocks
+    :type pooled: boolean, optional
+    
+    :return: the noise-augmented image shape, or the image itself if it does not fit the output block
+    :rtype: tuple or numpy array
     """
-    The noisify_data function parses through the data and calls the helper to do multi-processing augmentation.
+    
+    # attach the shared blocks
+    if pooled:
+        in_shm, out_shm = _attach(in_name), _attach(out_name)
+    else:
+        in_shm, out_shm = shared_memory.SharedMemory(name=in_name), shared_memory.SharedMemory(name=out_name)
+    
+    try:
+        # apply the noise to a view of the decoded image
+        image = np.ndarray(shape, dtype=np.uint8, buffer=in_shm.buf)
+        im_noisy = _noisify(noise_name, image)
+        del image
+        
+        # fall back to returning the array if it cannot be shared
+        if im_noisy.nbytes > out_shm.size:
+            return im_noisy
+        
+        # copy the result into the output block
+        result = np.ndarray(im_noisy.shape, dtype=np.uint8, buffer=out_shm.buf)
+        result[...] = im_noisy
+        del result
+        return im_noisy.shape
+    
+    # detach temporary blocks, the master owns and unlinks all blocks
+    finally:
+        if not pooled:
+            in_shm.close()
+            out_shm.close()
+
+
+def _write_shared(task, buffers, out, pooled, slot, free):
+    """
+    The _write_shared function is the single writer, it encodes the noise-augmented image and releases its slot.
+    
+    :param task: the (image path, write directory, noise function name) task from noise_helper
+    :type task: tuple
+    
+    :param buffers: the input and output shared memory blocks
+    :type buffers: list
+    
+    :param out: the noise-augmented image shape, or the image itself
+    :type out: tuple or numpy array
+    
+    :param pooled: flag whether the blocks are pooled segments or temporary blocks
+    :type pooled: boolean
+    
+    :param slot: the index of the in-flight slot
+    :type slot: integer
+    
+    :param free: the free-list of slot indices
+    :type free: queue
+    """
+    
+    # unpack the task
+    im_path, write_dir, noise_name = task
+    
+    try:
+        # view the result in shared memory unless it was returned directly
+        if isinstance(out, tuple):
+            im_noisy = np.ndarray(out, dtype=np.uint8, buffer=buffers[1].buf)
+        else:
+            im_noisy = out
+        
+        # write the image
+        im_name = os.path.basename(im_path).split(".")
+        image_write(im_noisy, write_dir, im_name[0], NOISE_FUNCTIONS[noise_name])
+        del im_noisy
+    
+    # release the slot for the next image
+    finally:
+        _release(buffers, pooled, slot, free)
+
+
+def _process_shared(task, segments, slot, free, transformer, writer):
+    """
+    The _process_shared function runs on the I/O threads, it decodes an image into its slot's shared segment, 
+    waits on the process worker for the transform and hands the result to the single writer.
+    
+    :param task: the (image path, write directory, noise function name) task from noise_helper
+    :type task: tuple
+    
+    :param segments: the pooled input and output shared memory segments of the slot
+    :type segments: tuple
+    
+    :param slot: the index of the in-flight slot
+    :type slot: integer
+    
+    :param free: the free-list of slot indices
+    :type free: queue
+    
+    :param transformer: the process pool applying the noise
+    :type transformer: ProcessPoolExecutor
+    
+    :param writer: the single thread writing images to disk
+    :type writer: ThreadPoolExecutor
+    
+    :return: the pending write
+    :rtype: Future
+    """
+    
+    # unpack the task
+    im_path, write_dir, noise_name = task
+    buffers = list(segments)
+    pooled = True
+    
+    try:
+        # read in the image as a uint8 numpy array
+        image = image_read(im_path)
+        
+        # oversized images get temporary blocks of their own, the output shares the input size
+        if image.nbytes > segments[0].size:
+            pooled = False
+            buffers = []
+            buffers.append(shared_memory.SharedMemory(create=True, size=image.nbytes))
+            buffers.append(shared_memory.SharedMemory(create=True, size=image.nbytes))
+        
+        # copy the decoded image into shared memory
+        shared = np.ndarray(image.shape, dtype=np.uint8, buffer=buffers[0].buf)
+        shared[...] = image
+        del shared
+        
+        # apply the noise in a worker process
+        out = transformer.submit(_transform_shared, noise_name, buffers[0].name, buffers[1].name, image.shape, pooled).result()
+        
+    # on failure release the slot here, the writer never sees it
+    except BaseException:
+        _release(buffers, pooled, slot, free)
+        raise
+    
+    # serialize the disk writes on the writer thread
+    return writer.submit(_write_shared, task, buffers, out, pooled, slot, free)
+
+
+def noisify_data(data_root, write_root = '', camera_flag = True, environment_flag = True, max_shape = (512, 512, 3)):
+    """
+    The noisify_data function parses through the data and dispatches the image-level tasks to a master-worker pipeline.
+    Decoding and encoding run on threads while the noise transforms run in worker processes, with images handed over in shared memory.
     NOTE: MUST EDIT THIS TO MATCH YOUR DATASET STRUCTURE.
         
     :param data_root: the path to the dataset root
@@ -187,20 +432,18 @@ def noisify_data(data_root, write_root = '', camera_flag = True, environment_fla
     :param environment_flag: flag whether environment noises are to be used
     :type environment_flag: boolean
     
+    :param max_shape: the largest expected image shape, used to size the pooled shared memory segments
+    :type max_shape: tuple, optional
+    
     :raises ValueError: asserts data path exists
     """
         
     # verify the directory exists
-    assert(os.path.exists(data))
-    
-    # set the local database root
-    proj_root = os.getcwd()
-
-    # set the local directory
-    os.chdir(data_root)
+    assert(os.path.exists(data_root))
 
     # iterate through the directories
-    directories = glob("*/")
+    with os.scandir(data_root) as entries:
+        directories = [entry.name for entry in entries if entry.is_dir()]
     directories = sorted(directories)
 
     # default the write root to the data root
@@ -209,27 +452,65 @@ def noisify_data(data_root, write_root = '', camera_flag = True, environment_fla
 
     # otherwise verify the directory exists
     else:
-        if not os.path.exists(write_root):
-            os.makedirs(write_root)
-
-    # setup the multiprocessing pool
-    pool = mp.Pool(mp.cpu_count())
+        make_dir(write_root)
 
-    # iterate through the directories
+    # generate the image-level tasks across all directories
     # NOTE: YOU MAY NEED TO ADJUST THIS TO YOUR DATASET
-    for num, person in enumerate(directories):
-        
-        # generate the local paths
-        person_data = os.path.join(data_root, person)
-        write_loc = os.path.join(write_root, person)
-        pool.apply_async(noise_helper, args=(person_data, write_loc, camera_flag, environment_flag))
-    
-    # close the pool
-    pool.close()
-    pool.join()
+    tasks = (task for person in directories
+             for task in noise_helper(os.path.join(data_root, person), os.path.join(write_root, person), camera_flag, environment_flag))
+
+    # a single directory or core does not amortize the pool startup, so run inline
+    if len(directories) == 1 or mp.cpu_count() == 1:
+        _init_worker(camera_flag, environment_flag)
+        for task in tasks:
+            _apply_one(task)
+        return
+
+    # master-worker pipeline: I/O threads decode, worker processes noisify, a single thread writes
+    # images are handed over in a fixed pool of shared segments, two per worker, which also bounds the images in flight
+    workers = mp.cpu_count()
+    slot_size = int(np.prod(max_shape))
+    segments = [(shared_memory.SharedMemory(create=True, size=slot_size), shared_memory.SharedMemory(create=True, size=slot_size))
+                for _ in range(2*workers)]
+    
+    # free-list of the slot indices
+    free = queue.Queue()
+    for slot in range(len(segments)):
+        free.put(slot)
+    
+    # only the in-flight futures are held, bounded by the slots rather than the dataset size
+    reads, writes = set(), set()
+    
+    # workers are started on demand from the reader threads, forking from a thread is unsafe so spawn them
+    context = mp.get_context('spawn')
+    try:
+        with ThreadPoolExecutor(max_workers=1) as writer, \
+             ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(camera_flag, environment_flag)) as transformer, \
+             ThreadPoolExecutor(max_workers=len(segments)) as readers:
+            
+            # dispatch the images as slots free up, tasks are generated lazily
+            for task in tasks:
+                slot = free.get()
+                reads.add(readers.submit(_process_shared, task, segments[slot], slot, free, transformer, writer))
+                
+                # reap the finished futures, surfacing errors from the read, transform or write stages early
+                done, reads = wait(reads, timeout=0)
+                writes.update(pending.result() for pending in done)
+                done, writes = wait(writes, timeout=0)
+                for pending in done:
+                    pending.result()
             
-    # reset the root directory
-    os.chdir(proj_root)
+            # drain the remaining futures
+            writes.update(pending.result() for pending in reads)
+            for pending in writes:
+                pending.result()
+    
+    # release the segment pool
+    finally:
+        for pair in segments:
+            for shm in pair:
+                shm.close()
+                shm.unlink()
 
 def reset_noises(write_root):
     """
@@ -242,41 +523,29 @@ def reset_noises(write_root):
     :raises ValueError: asserts write_root path exists
     """
         
-    # set the local database root
-    proj_root = os.getcwd()
-
-    # set the local directory
-    os.chdir(write_root)
-
-    # iterate through the directories
-    directories = glob("*/")
-    directories = sorted(directories)
+    # verify the directory exists
+    assert(os.path.exists(write_root))
 
-    # noise directories
-    camera_noises = [blur, gaussian, poisson, salt_and_pepper]
-    exposures = [under_expose, over_expose]
-    noises = camera_noises + exposures
+    # noise directory names, camera and environment
+    noise_names = frozenset(NOISE_FUNCTIONS)
 
-    # iterate through the participants
-    for num, person in enumerate(directories):
+    # sweep the write tree once, deleting the noise subdirectories wherever they occur
+    for dirpath, dirnames, _ in os.walk(write_root):
         
-        # generate the write directory path
-        write_dir = os.path.join(write_root,person)
-        print('Removing data:', write_dir)
-
-        # delete the noise subdirectories
-        for noisify in noises:
-            
-            # generate the noise-subdirectory
-            delete_dir = gen_os_path(write_dir, noisify.__name__)
-            
-            # delete if exists
-            if os.path.exists(delete_dir):
-                shutil.rmtree(delete_dir)
-
+        # split out the noise subdirectories at this level
+        noise_dirs = [name for name in dirnames if name in noise_names]
+        if noise_dirs:
+            print('Removing data:', dirpath)
+        
+        # delete them, missing directories are ignored rather than checked first
+        for name in noise_dirs:
+            shutil.rmtree(os.path.join(dirpath, name), ignore_errors=True)
+        
+        # prune the deleted directories from the walk
+        dirnames[:] = [name for name in dirnames if name not in noise_names]
         
-    # reset the root directory
-    os.chdir(proj_root)
+    # the memoized directories may have just been deleted, so forget them and let make_dir create them again
+    _CREATED_DIRS.clear()
 
                         
 if __name__ == "__main__":
@@ -9,6 +9,7 @@ import numpy as np
 import json
 import multiprocessing as mp 
 import math
+from functools import lru_cache, partial
 
 # basic cv tools
 import cv2 as cv
@@ -19,6 +20,114 @@ import skimage
 from PIL import Image, ImageOps
 from skimage import feature
 
+# random generator shared by the noise kernels, it also seeds opencv's generator per call
+_rng = np.random.default_rng()
+
+# optional gpu offload, only with an opencv build that has cuda devices
+try:
+    CUDA_AVAILABLE = cv.cuda.getCudaEnabledDeviceCount() > 0
+except (AttributeError, cv.error):
+    CUDA_AVAILABLE = False
+
+# the upload and download only pay off on large images, face crops stay on the cpu
+_CUDA_MIN_PIXELS = 1024*1024
+
+def seed_noise(seed = None):
+    """
+    The seed_noise function replaces the random generator shared by the noise kernels.
+    Forked worker processes inherit the parent's generator state, so each worker should call this once at startup.
+    
+    :param seed: the generator seed, fresh OS entropy is used if unspecified
+    :type seed: integer, optional
+    """
+    
+    # rebind the module generator, the noise tiles are drawn from it so they are redrawn too
+    global _rng
+    _rng = np.random.default_rng(seed)
+    _noise_tiles.clear()
+
+def noise_generator():
+    """
+    The noise_generator function returns the random generator shared by the noise kernels, as last seeded by seed_noise.
+    
+    :return: the shared random generator
+    :rtype: numpy Generator
+    """
+    
+    # look up the current module generator, seed_noise rebinds it
+    return _rng
+
+def _use_cuda(image):
+    """
+    The _use_cuda function decides whether an image is worth offloading to the gpu.
+    
+    :param image: the image to be processed
+    :type image: numpy array
+    
+    :return: whether to use the cuda path
+    :rtype: boolean
+    """
+    
+    # the cuda paths only handle single channel and BGR images, other layouts such as BGRA stay on the cpu
+    if image.ndim == 3 and image.shape[2] != 3: return False
+    
+    # require a device and enough pixels to amortize the transfers
+    return CUDA_AVAILABLE and image.shape[0]*image.shape[1] >= _CUDA_MIN_PIXELS
+
+
+@lru_cache(maxsize=16)
+def _cuda_gaussian(image_type, ksize, sigma):
+    """
+    The _cuda_gaussian function creates a cuda gaussian filter, filters are cached since creating one uploads the kernel.
+    
+    :param image_type: the opencv image type, e.g. cv.CV_8UC4
+    :type image_type: integer
+    
+    :param ksize: the kernel size, at most 31 on the gpu
+    :type ksize: integer
+    
+    :param sigma: the blur intensity coefficient
+    :type sigma: float
+    
+    :return: the gaussian filter
+    :rtype: cv.cuda.Filter
+    """
+    
+    # replicate the edges like the cpu path
+    return cv.cuda.createGaussianFilter(image_type, image_type, (ksize, ksize), sigma, sigma, cv.BORDER_REPLICATE, cv.BORDER_REPLICATE)
+
+
+def _blur_cuda(image, ksize, sigma):
+    """
+    The _blur_cuda function applies the gaussian blur on the gpu.
+    The cuda filters do not take 3-channel 8-bit images, so colour images are filtered as BGRA on the device.
+    
+    :param image: the image to be blurred
+    :type image: numpy array
+    
+    :param ksize: the kernel size, at most 31 on the gpu
+    :type ksize: integer
+    
+    :param sigma: the blur intensity coefficient
+    :type sigma: float
+    
+    :return: the blurred image
+    :rtype: numpy array
+    """
+    
+    # upload once and pad colour images to four channels
+    gpu = cv.cuda_GpuMat()
+    gpu.upload(image)
+    if image.ndim == 3: gpu = cv.cuda.cvtColor(gpu, cv.COLOR_BGR2BGRA)
+    
+    # filter on the device
+    gpu = _cuda_gaussian(gpu.type(), ksize, float(sigma)).apply(gpu)
+    
+    # drop the padding channel and download once
+    if image.ndim == 3: gpu = cv.cuda.cvtColor(gpu, cv.COLOR_BGRA2BGR)
+    return gpu.download()
+
+
 def poor_focus(image, sigma = None, IR = True):
     """
     The poor_focus function adds a randomized amount of blur to the image.
@@ -39,20 +148,79 @@ def poor_focus(image, sigma = None, IR = True):
     
     # check if specified parameter, else default
     if sigma == None:
-        sigma = random.randint(3, 5)
+        sigma = int(_rng.integers(3, 6))
         
-    # apply blur filter and convert back to uint8
-    image_noise = skimage.filters.gaussian(np.asarray(image), sigma=(sigma, sigma), truncate=3.5, channel_axis=2)
-    image_noise = np.uint8(image_noise*255)
+    # kernel radius truncated at 3.5 sigma, as skimage computes it
+    ksize = 2*int(3.5*sigma + 0.5) + 1
+    
+    # if infrared and stored as three equal channels, only one channel needs blurring
+    image = np.asarray(image)
+    gray = IR and image.ndim == 3 and image.shape[2] == 3 and (image[..., 0] == image[..., 1]).all() and (image[..., 0] == image[..., 2]).all()
+    if gray: image = np.ascontiguousarray(image[..., 0])
+    
+    # on large images use the gpu if available, its filters are limited to 31 taps
+    if _use_cuda(image) and ksize <= 31:
+        image_noise = _blur_cuda(image, ksize, sigma)
+    
+    # otherwise apply blur filter directly on the uint8 image, replicating the edges like skimage's 'nearest' mode
+    else:
+        image_noise = cv.GaussianBlur(image, (ksize, ksize), sigmaX=sigma, sigmaY=sigma, borderType=cv.BORDER_REPLICATE)
+    
+    # broadcast the blurred channel back to the stored layout
+    if gray: image_noise = cv.cvtColor(image_noise, cv.COLOR_GRAY2BGR)
 
     # return the noisy image
     return image_noise
 
-def dark_noise(image, var = None, IR = True, cv_image = False):
+# number of pregenerated dark noise tiles per variance and channel layout
+_NOISE_TILES = 4
+
+# the pregenerated dark noise tiles by variance and channel layout, see _noise_pool
+_noise_tiles = {}
+
+def _noise_pool(var, shape):
+    """
+    The _noise_pool function returns pregenerated gaussian dark noise tiles for a variance that cover an image of the given shape, see dark_noise.
+    The tiles are kept per variance and channel layout and grown to half as large again as the largest image seen, so a randomly offset crop of a random tile serves as a fresh noise draw for that image and anything smaller.
+    
+    :param var: the noise variance coefficient
+    :type var: float
+    
+    :param shape: the image shape
+    :type shape: tuple
+    
+    :return: the read-only int16 noise tiles
+    :rtype: numpy array
+    """
+    
+    # reuse the tiles while they leave a margin around the image, whatever its exact size
+    hh, ww = shape[:2]
+    key = (var, tuple(shape[2:]))
+    tiles = _noise_tiles.get(key)
+    if tiles is not None and tiles.shape[1] >= hh + hh//2 and tiles.shape[2] >= ww + ww//2:
+        return tiles
+    
+    # otherwise grow them to cover the image as well as anything covered before
+    tile_h, tile_w = hh + hh//2, ww + ww//2
+    if tiles is not None: tile_h, tile_w = max(tile_h, tiles.shape[1]), max(tile_w, tiles.shape[2])
+    
+    # draw every tile in a single pass, viewed as a single channel so every channel receives it
+    tiles = np.empty((_NOISE_TILES, tile_h, tile_w) + key[1], np.int16)
+    cv.setRNGSeed(int(_rng.integers(2**31)))
+    cv.randn(tiles.reshape(-1, tiles[0, 0].size), 0, math.sqrt(var)*255)
+    
+    # the tiles are shared between calls, so protect them from writes
+    tiles.flags.writeable = False
+    _noise_tiles[key] = tiles
+    
+    # return the noise tiles
+    return tiles
+
+def dark_noise(image, var = None, IR = True, cv_image = False, pooled = False):
     """
     The dark_noise function represents dark-noise or photo-receptor leakage. This is done with adding randomized gaussian noise.
     By default, it assumes a variance between .01 * 1 and .01 * 3 or can be specified.
-    Note this function needs PIL format to work properly; flags are used to convert from numpy as necessary.
+    Both PIL images (RGB) and numpy arrays (BGR) are accepted; the cv_image flag marks numpy inputs.
     
     :param image: the image to be noise-augmented
     :type image: PIL image or numpy array
@@ -66,32 +234,44 @@ def dark_noise(image, var = None, IR = True, cv_image = False):
     :param cv_image: flag to indicate whether numpy array or PIL image
     :type cv_image: boolean, optional
     
+    :param pooled: flag to crop the noise from pregenerated tiles rather than drawing it afresh, for generators called many times on images of similar size
+    :type pooled: boolean, optional
+    
     :return: the noise-augmented image
     :rtype: numpy array
     """
         
-    # if opencv image (numpy array) convert to PIL
-    if cv_image:
-        image = Image.fromarray(image)
+    # if PIL image convert to numpy, PIL images are RGB while opencv images are BGR
+    if not cv_image:
+        image = np.asarray(image)
         
-    # if infrared image, convert format 
-    if IR:
-        image = image.convert('LA')
+    # if infrared image, reduce to a single intensity channel
+    if IR and image.ndim == 3:
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY if cv_image else cv.COLOR_RGB2GRAY)
         
     # if variance not specified use randomized default
     if var == None:
-        var = .01*random.randint(1, 3)
+        var = .01*int(_rng.integers(1, 4))
+        
+    # if pooled, crop the noise from a random tile at a random offset
+    if pooled:
+        hh, ww = image.shape[:2]
+        tiles = _noise_pool(float(var), image.shape)
+        tile, y, x = _rng.integers([0, 0, 0], [_NOISE_TILES, tiles.shape[1] - hh + 1, tiles.shape[2] - ww + 1]).tolist()
+        noise = tiles[tile, y:y+hh, x:x+ww]
         
-    # apply gaussian noise and convert back to uint8
-    image_noise = skimage.util.random_noise(np.asarray(image), mode='gaussian', seed=None, clip=True, var = var)
-    image_noise = np.uint8(image_noise*255)
+    # otherwise draw the gaussian noise in place into an int16 buffer, viewed as a single channel so every channel receives it
+    else:
+        cv.setRNGSeed(int(_rng.integers(2**31)))
+        noise = np.empty(image.shape, np.int16)
+        cv.randn(noise.reshape(image.shape[0], -1), 0, math.sqrt(var)*255)
+    
+    # add the noise with saturation back to uint8
+    image_noise = cv.add(image, noise, dtype=cv.CV_8U)
     
     # if infrared, need to convert back for proper storage
     if IR:        
-        image_noise = Image.fromarray(image_noise)
-        w, h = image_noise.size
-        image_noise = image_noise.convert("RGB")
-        image_noise = np.asarray(image_noise)
+        image_noise = cv.cvtColor(image_noise, cv.COLOR_GRAY2BGR if cv_image else cv.COLOR_GRAY2RGB)
 
     # return the noise-augmented image
     return image_noise
@@ -100,7 +280,7 @@ def dark_noise(image, var = None, IR = True, cv_image = False):
 def shot_noise(image, gauss = None, IR = True, cv_image = False):
     """
     The shot_noise function represents shot-noise or irregular photon distributione. This is done with adding poisson noise.
-    Note this function needs PIL format to work properly; flags are used to convert from numpy as necessary.
+    Both PIL images (RGB) and numpy arrays (BGR) are accepted; the cv_image flag marks numpy inputs.
     
     :param image: the image to be noise-augmented
     :type image: PIL image or numpy array
@@ -115,24 +295,25 @@ def shot_noise(image, gauss = None, IR = True, cv_image = False):
     :rtype: numpy array
     """
 
-    # if opencv image (numpy array) convert to PIL
-    if cv_image:
-        image = Image.fromarray(image)
+    # if PIL image convert to numpy, PIL images are RGB while opencv images are BGR
+    if not cv_image:
+        image = np.asarray(image)
         
-    # if infrared image, convert format 
-    if IR:
-        image = image.convert('LA')
+    # if infrared image, reduce to a single intensity channel
+    if IR and image.ndim == 3:
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY if cv_image else cv.COLOR_RGB2GRAY)
+    
+    # scale intensities to photon counts by the number of distinct levels (rounded up to a power of two) as skimage does
+    levels = np.count_nonzero(np.bincount(image.ravel(), minlength=256))
+    vals = 2 ** math.ceil(math.log2(levels))
     
     # add poisson noise and convert back to uint8
-    image_noise = skimage.util.random_noise(np.asarray(image), mode='poisson', seed=None, clip=True)
-    image_noise = np.uint8(image_noise*255)
+    image_noise = _rng.poisson(image.astype(np.float32) * np.float32(vals/255.0)) * np.float32(255.0/vals)
+    image_noise = np.clip(image_noise, 0, 255).astype(np.uint8)
         
     # if infrared, need to convert back for proper storage
     if IR:        
-        image_noise = Image.fromarray(image_noise)
-        w, h = image_noise.size
-        image_noise = image_noise.convert("RGB")
-        image_noise = np.asarray(image_noise)
+        image_noise = cv.cvtColor(image_noise, cv.COLOR_GRAY2BGR if cv_image else cv.COLOR_GRAY2RGB)
         
     # return the noise-augmented image
     return image_noise
@@ -142,7 +323,7 @@ def salt_and_pepper(image, grain_amount = None, IR = True, cv_image = False):
     """
     The salt_and_pepper function represents analog to digital conversion error. This is done with randomly assigning 0 and 255 values.
     By default, it assumes a graininess level .001 * 3 and .001 * 6 or can be specified.
-    Note this function needs PIL format to work properly; flags are used to convert from numpy as necessary.
+    Both PIL images (RGB) and numpy arrays (BGR) are accepted; the cv_image flag marks numpy inputs.
     
     :param image: the image to be noise-augmented
     :type image: PIL image or numpy array
@@ -160,47 +341,203 @@ def salt_and_pepper(image, grain_amount = None, IR = True, cv_image = False):
     :rtype: numpy array
     """
         
-    # if IR and PIL need to grayscale first or get weird issues
+    # if IR and PIL need to grayscale first or get weird issues, opencv uses the same luma weights as PIL
     if IR and not cv_image:
-        image = ImageOps.grayscale(image)
+        image = np.asarray(image)
+        if image.ndim == 3: image = cv.cvtColor(image, cv.COLOR_RGB2GRAY)
         
     # if graininess not specified use randomized default
     if grain_amount == None:
-        grain_amount = .001 * random.randint(3, 6)
+        grain_amount = .001 * int(_rng.integers(3, 7))
+    
+    # draw a single uniform map in place, one draw per pixel broadcast over the channels
+    image_noise = np.array(image, dtype=np.uint8)
+    cv.setRNGSeed(int(_rng.integers(2**31)))
+    noise_map = np.empty(image_noise.shape[:2], np.float32)
+    cv.randu(noise_map, 0, 1)
     
-    # apply noise and convert back to uint8
-    image_noise = skimage.util.random_noise(np.asarray(image), mode='s&p', seed=None, clip=True, amount = grain_amount)
-    image_noise = np.uint8(image_noise*255)
+    # apply noise directly in uint8, pepper at the low end and salt at the high end
+    image_noise[noise_map < grain_amount/2] = 0
+    image_noise[noise_map > 1 - grain_amount/2] = 255
         
     # return noise-augmented image
     return image_noise
 
 
-def under_expose(image, gamma = None, environment_flag = False):
+def _gamma_lut(gamma):
+    """
+    The _gamma_lut function returns the 256-entry uint8 lookup table for a gamma adjustment.
+    Applying it with cv.LUT matches skimage.exposure.adjust_gamma on uint8 images without the per-pixel power.
+    Tables are cached on the gamma rounded to three decimals, which is well below one intensity level of difference.
+    
+    :param gamma: the gamma correction to be applied
+    :type gamma: float
+    
+    :return: the read-only gamma lookup table
+    :rtype: numpy array
+    """
+    
+    # look up the table for the rounded gamma
+    return _build_gamma_lut(round(float(gamma), 3))
+
+
+@lru_cache(maxsize=4096)
+def _build_gamma_lut(gamma):
+    """
+    The _build_gamma_lut function evaluates the gamma curve once per intensity level, see _gamma_lut.
+    
+    :param gamma: the rounded gamma correction
+    :type gamma: float
+    
+    :return: the read-only gamma lookup table
+    :rtype: numpy array
+    """
+    
+    # evaluate the gamma curve once per intensity level
+    lut = np.clip(((np.arange(256)/255.0) ** gamma) * 255, 0, 255).astype(np.uint8)
+    
+    # the table is shared between callers, so protect it from writes
+    lut.flags.writeable = False
+    
+    # return the lookup table
+    return lut
+
+
+def _apply_gamma(image, gamma):
+    """
+    The _apply_gamma function applies the gamma lookup table to a uint8 image, on the gpu for large images if available.
+    
+    :param image: the image to be adjusted
+    :type image: numpy array
+    
+    :param gamma: the gamma correction to be applied
+    :type gamma: float
+    
+    :return: the adjusted image
+    :rtype: numpy array
+    """
+    
+    # on large images map the table on the gpu
+    if _use_cuda(image):
+        gpu = cv.cuda_GpuMat()
+        gpu.upload(image)
+        return cv.cuda.createLookUpTable(_gamma_lut(gamma)).transform(gpu).download()
+    
+    # otherwise map it on the cpu
+    return cv.LUT(image, _gamma_lut(gamma))
+
+
+def _u8_hist(image):
+    """
+    The _u8_hist function computes the normalized 256-bin intensity histogram of a uint8 image over all of its channels.
+    
+    :param image: the image to be binned
+    :type image: numpy array
+    
+    :return: the fraction of the pixel values at each intensity level
+    :rtype: numpy array
+    """
+    
+    # count every channel value, a single-channel calcHist would ignore green and red
+    return np.bincount(image.ravel(), minlength=256) / image.size
+
+
+def _solve_gamma(hist, low, high, iterations = 40):
+    """
+    The _solve_gamma function finds a gamma whose adjusted image has a normalized mean intensity within [low, high].
+    The adjusted mean is evaluated on the 256-bin histogram rather than the pixels, so every step is O(256).
+    Newton steps on the mean towards the middle of the band typically land in it within two or three steps, a log-space bisection takes over if a step leaves the bracket.
+    If the band is unreachable the closest gamma in [0.01, 10] is returned.
+    
+    :param hist: the normalized intensity histogram of the image
+    :type hist: numpy array
+    
+    :param low: the lowest acceptable mean intensity
+    :type low: float
+    
+    :param high: the highest acceptable mean intensity
+    :type high: float
+    
+    :param iterations: the maximum number of steps
+    :type iterations: integer, optional
+    
+    :return: the gamma correction to be applied
+    :rtype: float
+    """
+    
+    # normalized intensity levels and their logs, zero is clamped as its power vanishes anyway
+    levels = np.arange(256) / 255.0
+    log_levels = np.log(np.maximum(levels, 1/512))
+    
+    # initial guess as if every pixel had the mean intensity, m**gamma = target
+    target = (low + high) / 2
+    mean = float(np.dot(levels, hist))
+    gamma = math.log(target) / math.log(mean) if 0 < mean < 1 else 1.0
+    
+    # bracket the gamma, the lower bound brightens and the upper bound darkens
+    brighter, darker = .01, 10.0
+    gamma = min(max(gamma, brighter), darker)
+    
+    # iterate until the adjusted mean of the lookup table falls in the band
+    for _ in range(iterations):
+        new_gamma = float(np.dot(_gamma_lut(gamma), hist)) / 255.0
+        
+        # too bright, move the brighter bound up
+        if new_gamma > high:
+            brighter = gamma
+            
+        # too dark, move the darker bound down
+        elif new_gamma < low:
+            darker = gamma
+            
+        # within the band
+        else:
+            break
+        
+        # newton step on the smooth mean, whose derivative in gamma is negative
+        powered = levels ** gamma
+        slope = float(np.dot(powered * log_levels, hist))
+        step = gamma - (float(np.dot(powered, hist)) - target) / slope if slope < 0 else darker
+        
+        # keep the step if it stays inside the bracket, otherwise bisect in log space
+        gamma = step if brighter < step < darker else math.sqrt(brighter*darker)
+    
+    # return the solved gamma
+    return gamma
+
+
+def under_expose(image, gamma = None, environment_flag = False, roi = None):
     """
     The under_expose function represents poor image contrast where features are lost due to lack of exposure. 
-    This is done with iteratively adjusting gamma down until it meets the threshold, but is above a floor (necessary to ensure some contrast).
+    This is done with solving for the gamma on the intensity histogram so the result meets the threshold, but is above a floor (necessary to ensure some contrast).
     By default, it assumes a gamma target of 0.15 or 0.8 * the input for environmental blending or can be specified.
     For defaults on environmental effects, see the noise_generators_environment.py file.
     
     :param image: the image to be noise-augmented
     :type image: PIL image or numpy array
     
-    :param gamma: the target gamma
-    :type gamma: integer, optional
+    :param gamma: the gamma correction, solved from the targets if unspecified
+    :type gamma: float, optional
     
     :param environment_flag: flag to indicate whether noise is being used for environmental effects blending or not
     :type environment_flag: boolean, optional
     
-    :return: the noise-augmented image
+    :param roi: the (x, y, width, height) region to adjust, the gamma is still solved on the whole image
+    :type roi: tuple, optional
+    
+    :return: the noise-augmented image, or only its region if one is given
     :rtype: numpy array
     """
 
+    # work on the uint8 array so the gamma can be applied as a lookup table
+    image = np.asarray(image)
+
     # if gamma unspecified use the defaults
     if gamma == None:
         
-        # calculate the baseline
-        original_gamma = skimage.img_as_float(image).mean()
+        # calculate the baseline from the histogram
+        hist = _u8_hist(image)
+        original_gamma = float(np.dot(np.arange(256), hist)) / 255.0
         
         # if environmental blending, do a simple relative decrease
         if environment_flag:
@@ -212,92 +549,212 @@ def under_expose(image, gamma = None, environment_flag = False):
             desired = .15
             floor = .03
             
-        # calculate the deviation to be applied
-        gamma = math.exp(1+original_gamma-desired)
-    
-    # adjust gamma in a do-while loop format
-    # first apply gamma deviation and calculate the new gamma
-    image_noise = skimage.exposure.adjust_gamma(np.asarray(image), gamma)
-    new_gamma = skimage.img_as_float(image_noise).mean()
-    
-    # if gamma does not meet targets, iteratively adjust it
-    while (new_gamma > desired or new_gamma < floor):
-        
-        # if below floor, adjust correction slightly less
-        if new_gamma < floor:
-            gamma -= .25*random.random()
-        
-        # if above target, adjust correction slightly more
-        elif new_gamma > desired:
-            gamma += .25*random.random()
-        
-        # apply gamma deviation and re-calculate the new gamma
-        image_noise = skimage.exposure.adjust_gamma(np.asarray(image), gamma)
-        new_gamma = skimage.img_as_float(image_noise).mean()
+        # solve for the correction, a dark input cannot go below the floor
+        gamma = _solve_gamma(hist, floor, max(desired, floor))
+    
+    # apply the gamma correction once as a lookup table, only within the region if one is given
+    if roi != None:
+        x, y, w, h = roi
+        image = image[y:y+h, x:x+w]
+    image_noise = _apply_gamma(image, gamma)
             
     # return noise-augmented image
     return image_noise
 
 
-def over_expose(image, gamma = None, environment_flag = False):
+def over_expose(image, gamma = None, environment_flag = False, roi = None):
     """
     The over_expose function represents poor image contrast where features are saturated due to too much exposure. 
-    This is done with iteratively adjusting gamma up until it meets the threshold, but is below a ceiling (necessary to ensure some contrast).
+    This is done with solving for the gamma on the intensity histogram so the result meets the threshold, but is below a ceiling (necessary to ensure some contrast).
     By default, it assumes a gamma target of 0.85 or 1.2 * the input for environmental blending or can be specified.
     For defaults on environmental effects, see the noise_generators_environment.py file.
     
     :param image: the image to be noise-augmented
     :type image: PIL image or numpy array
     
-    :param gamma: the target gamma
-    :type gamma: integer, optional
+    :param gamma: the gamma correction, solved from the targets if unspecified
+    :type gamma: float, optional
     
     :param environment_flag: flag to indicate whether noise is being used for environmental effects blending or not
     :type environment_flag: boolean, optional
     
-    :return: the noise-augmented image
+    :param roi: the (x, y, width, height) region to adjust, the gamma is still solved on the whole image
+    :type roi: tuple, optional
+    
+    :return: the noise-augmented image, or only its region if one is given
     :rtype: numpy array
     """
 
+    # work on the uint8 array so the gamma can be applied as a lookup table
+    image = np.asarray(image)
+
     # if gamma unspecified use the defaults
     if gamma == None:
         
-        # calculate the baseline
-        original_gamma = skimage.img_as_float(image).mean()
+        # calculate the baseline from the histogram
+        hist = _u8_hist(image)
+        original_gamma = float(np.dot(np.arange(256), hist)) / 255.0
         
-        # if environmental blending, do a simple relative decrease
+        # if environmental blending, do a simple relative increase
         if environment_flag:
             desired = original_gamma*1.2
             ceiling = .75
                 
-        # otherwise under expose to the point of lost features
+        # otherwise over expose to the point of saturated features
         else:
             desired = .85
-            floor = .9
+            ceiling = .9
             
-        # calculate the deviation to be applied with enforcing non-negative corrections
-        gamma = math.exp(desired-original_gamma)-1
-        if gamma <= 0: gamma = .1
+        # solve for the correction, a bright input cannot go above the ceiling
+        gamma = _solve_gamma(hist, min(desired, ceiling), ceiling)
                 
-    # adjust gamma in a do-while loop format
-    # first apply gamma deviation and calculate the new gamma
-    image_noise = skimage.exposure.adjust_gamma(np.asarray(image), gamma)
-    new_gamma = skimage.img_as_float(image_noise).mean()
-    
-    # if gamma does not meet targets, iteratively adjust it
-    while (new_gamma < desired or new_gamma > ceiling):
-        
-        # if below floor, adjust correction slightly more
-        if new_gamma < desired:
-            gamma -= .25*random.random()
-        
-        # if above ceiling, adjust correction slightly less
-        elif new_gamma > ceiling:
-            gamma += .25*random.random()
-        
-        # apply gamma deviation and re-calculate the new gamma
-        image_noise = skimage.exposure.adjust_gamma(np.asarray(image), gamma)
-        new_gamma = skimage.img_as_float(image_noise).mean()
+    # apply the gamma correction once as a lookup table, only within the region if one is given
+    if roi != None:
+        x, y, w, h = roi
+        image = image[y:y+h, x:x+w]
+    image_noise = _apply_gamma(image, gamma)
             
     # return noise-augmented image
     return image_noise
+
+
+def image_read(im_path):
+    """
+    The image_read function reads an image from disk into a uint8 numpy array.
+    The file is read in one sequential pass and decoded from memory, which lets the OS readahead coalesce the reads.
+    
+    :param im_path: the path to the image
+    :type im_path: string
+    
+    :return: the decoded BGR image
+    :rtype: numpy array
+    
+    :raises IOError: if the image could not be decoded
+    """
+    
+    # read the raw bytes and decode them as a 3-channel image, opencv reports a failed decode by returning None
+    buffer = np.fromfile(im_path, dtype=np.uint8)
+    image = cv.imdecode(buffer, cv.IMREAD_COLOR)
+    if image is None:
+        raise IOError('Could not decode image: ' + im_path)
+    
+    # return the decoded image
+    return image
+
+
+def image_write(noise_im, im_dir, im_name, noise, counter = -1, compression = 3):
+    """
+    The image_write function automates writing the noise-augmented image to an appropriate directory. 
+    
+    :param noise_im: the noise-augmented image
+    :type noise_im: numpy array
+    
+    :param im_dir: the path to the image write directory
+    :type im_dir: string
+    
+    :param im_name: the name of the image to be writteny
+    :type im_name: string
+    
+    :param noise: the noise augmentation function
+    :type noise: function pointer
+    
+    :param counter: a counter to append to the image for automation
+    :type counter: integer, optional
+    
+    :param compression: the PNG compression level (0-9), lower levels trade file size for faster encoding
+    :type compression: integer, optional
+    
+    :return: the noise-augmented image
+    :rtype: numpy array
+    
+    :raises IOError: if the image could not be encoded or written
+    """
+    
+    # if a counter is specified, format it accordingly
+    if counter >= 0: count = '_'+str(counter).zfill(4)
+    else: count = ''
+    
+    # generate the path and write the image to disk, single channel arrays are written as grayscale
+    write_path = os.path.join(im_dir, im_name + '_' + noise.__name__ + count + '.png')
+    
+    # opencv reports a failed encode or write by its return value rather than raising
+    if not cv.imwrite(write_path, noise_im, [cv.IMWRITE_PNG_COMPRESSION, compression]):
+        raise IOError('Could not write image: ' + write_path)
+
+
+def init_pool_worker():
+    """
+    The init_pool_worker function prepares a batch worker process, it is intended as the pool initializer.
+    Each worker reseeds the noise generator, and opencv's own threading is disabled since the pool already occupies every core.
+    """
+    
+    # sequential opencv calls and a fresh generator per worker
+    cv.setNumThreads(0)
+    seed_noise()
+
+
+def _augment_one(im_path, noise_fn, im_dir, kwargs):
+    """
+    The _augment_one function reads one image, applies a noise function and writes the result, it is the run_batch worker task.
+    
+    :param im_path: the path to the image to be noise-augmented
+    :type im_path: string
+    
+    :param noise_fn: the noise augmentation function
+    :type noise_fn: function pointer
+    
+    :param im_dir: the path to the image write directory
+    :type im_dir: string
+    
+    :param kwargs: the keyword arguments forwarded to the noise function
+    :type kwargs: dictionary
+    """
+    
+    # read, augment and write the image
+    im_name = os.path.splitext(os.path.basename(im_path))[0]
+    image_write(noise_fn(image_read(im_path), **kwargs), im_dir, im_name, noise_fn)
+
+
+def run_batch(paths, noise_fn, im_dir, workers = None, chunksize = 16, **kwargs):
+    """
+    The run_batch function applies a single noise function to a list of images across a process pool and writes them to one directory.
+    Each worker reseeds the noise generator at startup so no two workers draw the same noise.
+    For the full dataset layout with randomized noise per image, see noisify_data in noise_faces.py.
+    
+    :param paths: the paths to the images to be noise-augmented
+    :type paths: list
+    
+    :param noise_fn: the noise augmentation function, it must be defined at module level to be sent to the workers
+    :type noise_fn: function pointer
+    
+    :param im_dir: the path to the image write directory
+    :type im_dir: string
+    
+    :param workers: the number of worker processes, all cores by default
+    :type workers: integer, optional
+    
+    :param chunksize: the number of images sent to a worker at a time
+    :type chunksize: integer, optional
+    
+    :param kwargs: the keyword arguments forwarded to the noise function, e.g. cv_image = True
+    :type kwargs: dictionary, optional
+    
+    :return: the number of images written
+    :rtype: integer
+    """
+    
+    # default to all cores and make sure the output exists
+    if workers == None: workers = os.cpu_count() or 1
+    os.makedirs(im_dir, exist_ok=True)
+    
+    # spawn the workers so none inherits the parent's generator state
+    task = partial(_augment_one, noise_fn=noise_fn, im_dir=im_dir, kwargs=kwargs)
+    with mp.get_context('spawn').Pool(workers, initializer=init_pool_worker) as pool:
+        
+        # drain the results as they complete, order does not matter
+        count = 0
+        for _ in pool.imap_unordered(task, paths, chunksize=chunksize):
+            count += 1
+    
+    # return the number of images written
+    return count
@@ -8,6 +8,10 @@ import random
 import numpy as np
 import json
 import multiprocessing as mp 
+import threading
+import atexit
+import hashlib
+from functools import partial
 
 # basic cv tools
 import cv2 as cv
@@ -19,78 +23,534 @@ from PIL import Image, ImageOps
 from skimage import feature
 
 # helper generators
-from noise_generators_camera import poor_focus, dark_noise, shot_noise, salt_and_pepper, under_expose, over_expose
+from noise_generators_camera import poor_focus, dark_noise, shot_noise, salt_and_pepper, under_expose, over_expose, noise_generator, init_pool_worker, image_read
 
-def point_source(image, scale = None, IR = True):
+# deterministic exposure variants shared by the generators, the noise on top of them is drawn per call
+ENV_VARIANTS = ('over', 'under', 'over_blur', 'under_blur')
+
+# reach of the sigma 2 blending blur, int(3.5*2 + .5) pixels as poor_focus truncates it
+_BLUR_RADIUS = 7
+
+def _variant(variants, image, name, roi = None):
     """
-    The point_source function models specular point sources.
-    This is done with modelling randomized ellipses, which are over-exposed, under-exposing the background and blending the boundary.
-    By default, it assumes a randomized ellipse size between .05 and .035 with random placement. These can alternatively be specified.
+    The _variant function returns an exposure variant of the image, computing and storing it in the variants dictionary if missing.
+    Variants of a region are stored under (name, roi), the exposure is still solved on the whole image so they match the full variant.
+    
+    :param variants: the variants computed so far, keyed by name
+    :type variants: dictionary
     
     :param image: the image to be noise-augmented
     :type image: numpy array
     
-    :param scale: the ellipse scale relative to the image size
-    :type scale: float, optional
+    :param name: the variant name, one of ENV_VARIANTS
+    :type name: string
     
-    :param IR: flag to indicate whether infrared image or not
-    :type IR: boolean, optional
+    :param roi: the (x, y, width, height) region to compute, the whole image if unspecified
+    :type roi: tuple, optional
     
-    :return: the noise-augmented image
+    :return: the exposure variant
+    :rtype: numpy array
+    """
+    
+    # a full variant already computed covers any region
+    if roi != None and name in variants:
+        x, y, w, h = roi
+        return variants[name][y:y+h, x:x+w]
+    
+    # compute the variant on a miss, the blurs reuse their exposure
+    key = name if roi == None else (name, roi)
+    if key not in variants:
+        if name == 'over': variants[key] = over_expose(image, environment_flag = True, roi = roi)
+        elif name == 'under': variants[key] = under_expose(image, environment_flag = True, roi = roi)
+        else: variants[key] = poor_focus(_variant(variants, image, name[:-len('_blur')], roi), 2)
+        
+    # return the variant
+    return variants[key]
+
+def _region_of_interest(labels, pad):
+    """
+    The _region_of_interest function computes the bounding box of the labelled regions, padded and clipped to the image.
+    
+    :param labels: the single channel region labels
+    :type labels: numpy array
+    
+    :param pad: the padding on each side in pixels
+    :type pad: integer
+    
+    :return: the (x, y, width, height) region
+    :rtype: tuple
+    """
+    
+    # bound the nonzero labels and pad within the image
+    hh, ww = labels.shape
+    x, y, w, h = cv.boundingRect(labels)
+    x0, y0 = max(x - pad, 0), max(y - pad, 0)
+    x1, y1 = min(x + w + pad, ww), min(y + h + pad, hh)
+    
+    # return the padded region
+    return (x0, y0, x1 - x0, y1 - y0)
+
+def _rows_of_interest(top, bottom, shape, pad):
+    """
+    The _rows_of_interest function computes the full width band between two rows, padded and clipped to the image.
+    
+    :param top: the first row of the band
+    :type top: integer
+    
+    :param bottom: the last row of the band
+    :type bottom: integer
+    
+    :param shape: the image height and width
+    :type shape: tuple
+    
+    :param pad: the padding above and below in pixels
+    :type pad: integer
+    
+    :return: the (x, y, width, height) region
+    :rtype: tuple
+    """
+    
+    # pad the rows within the image
+    hh, ww = shape
+    y0, y1 = max(top - pad, 0), min(bottom + 1 + pad, hh)
+    
+    # return the padded band
+    return (0, y0, ww, y1 - y0)
+
+def environment_layers(image):
+    """
+    The environment_layers function computes every exposure variant of an image once, in memory.
+    Pass the result as variants to each environment generator applied to the same image, only the per-call noise is then left to compute.
+    
+    :param image: the image to be noise-augmented
+    :type image: numpy array
+    
+    :return: the exposure variants keyed by name
+    :rtype: dictionary
+    """
+    
+    # compute each variant, the blurs reuse their exposure
+    variants = {}
+    for name in ENV_VARIANTS:
+        _variant(variants, image, name)
+        
+    # return the variants
+    return variants
+
+def precompute_env_variants(image_path, cache_dir):
+    """
+    The precompute_env_variants function computes the exposure variants of an image once and caches them to disk as PNGs.
+    Later calls read them back, and the result can be passed as variants to any of the environment generators.
+    The cache files are keyed on the absolute image path and its modification time, so images sharing a name or edited since stay apart.
+    
+    :param image_path: the path to the image to be noise-augmented
+    :type image_path: string
+    
+    :param cache_dir: the directory where the variants are stored
+    :type cache_dir: string
+    
+    :return: the exposure variants keyed by name
+    :rtype: dictionary
+    
+    :raises IOError: if a variant could not be written to the cache
+    """
+    
+    # the cached variant paths, datasets reuse image names across directories so the name alone is not a key
+    im_name = os.path.splitext(os.path.basename(image_path))[0]
+    source = os.path.abspath(image_path) + ':' + str(os.stat(image_path).st_mtime_ns)
+    im_key = im_name + '_' + hashlib.sha1(source.encode()).hexdigest()[:16]
+    paths = {name: os.path.join(cache_dir, im_key + '_' + name + '.png') for name in ENV_VARIANTS}
+    
+    # read the variants back if they are all cached and decode, a truncated file is recomputed below
+    if all(os.path.isfile(path) for path in paths.values()):
+        variants = {name: cv.imread(path) for name, path in paths.items()}
+        if all(variant is not None for variant in variants.values()):
+            return variants
+    
+    # otherwise compute and cache them, opencv reports a failed write by its return value rather than raising
+    variants = environment_layers(image_read(image_path))
+    os.makedirs(cache_dir, exist_ok=True)
+    for name in ENV_VARIANTS:
+        if not cv.imwrite(paths[name], variants[name]):
+            raise IOError('Could not write image: ' + paths[name])
+        
+    # return the variants
+    return variants
+
+# per-thread scratch buffer for the region labels
+_scratch = threading.local()
+
+def _label_buffer(shape):
+    """
+    The _label_buffer function returns the calling thread's zeroed scratch buffer for the region labels.
+    The labels never leave the generator that paints them, so the buffer is only reallocated when the image size changes.
+    
+    :param shape: the image height and width
+    :type shape: tuple
+    
+    :return: the zeroed single channel label buffer
+    :rtype: numpy array
+    """
+    
+    # reallocate on first use or a new size, otherwise clear in place
+    labels = getattr(_scratch, 'labels', None)
+    if labels is None or labels.shape != shape:
+        labels = _scratch.labels = np.zeros(shape, np.uint8)
+    else:
+        labels.fill(0)
+        
+    # return the cleared buffer
+    return labels
+
+def _streak_geometry(hh, ww, rng, blend_direction, streak_angle = None):
+    """
+    The _streak_geometry function draws the slice across the image for the streak generators, along with its blending slice.
+    
+    :param hh: the image height
+    :type hh: integer
+    
+    :param ww: the image width
+    :type ww: integer
+    
+    :param rng: the random generator for the geometry
+    :type rng: numpy Generator
+    
+    :param blend_direction: 1 to blend below the slice, -1 to blend above it
+    :type blend_direction: integer
+    
+    :param streak_angle: the angle at which to slice the image
+    :type streak_angle: integer, optional
+    
+    :return: the slice and blending slice polygons
+    :rtype: tuple
+    """
+    
+    # if no angle is specified, randomly generate the slice
+    if streak_angle == None:    
+        top_left = [0, 0]
+        top_right = [ww, 0]
+        left_cut, right_cut = rng.integers(int(1*hh/4), int(3*hh/4) + 1, size=2).tolist()
+        bottom_left = [0, left_cut]
+        bottom_right = [ww, right_cut]
+        
+    # otherwise calculate the specified slice
+    else:
+        
+        # enforce streak to be overhead
+        assert(streak_angle > 0 and streak_angle < 180)
+        raise ValueError('Function to come')
+    
+    # generate the slice
+    pts = np.array([top_left, top_right, bottom_right, bottom_left])
+    
+    # blend crop geometries, shifted off the slice in the blending direction
+    blend_slice = blend_direction*.01*min(hh, ww)
+    blend_left = [0, int(left_cut + blend_slice)]
+    blend_right = [ww, int(right_cut + blend_slice)]
+    pts_blend = np.array([top_left, top_right, blend_right, blend_left])
+    
+    # return the slice geometries
+    return pts, pts_blend
+
+def _pipe_geometry(hh, ww, rng, pipe_angle = None):
+    """
+    The _pipe_geometry function draws the pipe across the image for the pipe generators, along with the outer strips and their unblended parts.
+    
+    :param hh: the image height
+    :type hh: integer
+    
+    :param ww: the image width
+    :type ww: integer
+    
+    :param rng: the random generator for the geometry
+    :type rng: numpy Generator
+    
+    :param pipe_angle: the angle at which to create the image pipe
+    :type pipe_angle: integer, optional
+    
+    :return: the pipe, top strip, bottom strip, top blending and bottom blending polygons
+    :rtype: tuple
+    """
+    
+    # if no angle specified, randomly generate the pipe geometry
+    if pipe_angle == None:
+        top_low, top_high = int(.1*hh), int(hh/3) + 1
+        bottom_low, bottom_high = int(hh/2*1.1), int(2/3*hh) + 1
+        top_left_cut, top_right_cut, bottom_left_cut, bottom_right_cut = rng.integers([top_low, top_low, bottom_low, bottom_low], [top_high, top_high, bottom_high, bottom_high]).tolist()
+
+        top_left = [0, top_left_cut]
+        top_right = [ww, top_right_cut]
+        bottom_left = [0, bottom_left_cut]
+        bottom_right = [ww, bottom_right_cut]
+        
+    # otherwise calculate the specified pipe
+    else:
+        
+        # enforce streak to be overhead
+        assert(pipe_angle > 0 and pipe_angle < 180)
+        raise ValueError('Function to come')        
+    
+    # generate the pipe boundaries
+    pts = np.array([top_left, top_right, bottom_right, bottom_left])
+    pts_top = np.array([[0,0], [ww, 0], top_right, top_left])
+    pts_bottom = np.array([bottom_left, bottom_right, [ww, hh], [0,hh]])
+
+    # determine the crop blending points
+    blend_slice = .01*min(hh, ww)
+    blend_top_left = [0, int(top_left_cut - blend_slice)]
+    blend_top_right = [ww, int(top_right_cut - blend_slice)]
+    blend_bottom_left = [0, int(bottom_left_cut + blend_slice)]
+    blend_bottom_right = [ww, int(bottom_right_cut + blend_slice)]
+    
+    # generate the blending boundaries
+    pts_blend_top = np.array([[0,0], [ww,0], blend_top_right, blend_top_left])
+    pts_blend_bottom = np.array([blend_bottom_left, blend_bottom_right, [ww, hh], [0,hh]])
+    
+    # return the pipe geometries
+    return pts, pts_top, pts_bottom, pts_blend_top, pts_blend_bottom
+
+def _compose(labels, layers, rois = None):
+    """
+    The _compose function combines the effect layers into a single image, taking each pixel from the layer its region label selects.
+    Each region is copied once through a single channel mask, rather than masking every layer and summing them.
+    
+    :param labels: the single channel region labels, indexing into the layers
+    :type labels: numpy array
+    
+    :param layers: the effect images, the first one being the full background
+    :type layers: list
+    
+    :param rois: the (x, y, width, height) region covered by each of the other layers, None for the whole image, all whole if unspecified
+    :type rois: list, optional
+    
+    :return: the combined image
     :rtype: numpy array
     """
+    
+    # start from the background
+    image_compose = layers[0].copy()
+    if rois == None: rois = [None]*(len(layers) - 1)
+    
+    # copy each labelled region over the background, through a view of the region its layer covers
+    for label, roi in enumerate(rois, 1):
+        region, target = labels, image_compose
+        if roi != None:
+            x, y, w, h = roi
+            region, target = labels[y:y+h, x:x+w], image_compose[y:y+h, x:x+w]
         
+        # opencv reallocates rather than writes into a view of another shape, which would silently drop the region
+        assert(layers[label].shape == target.shape)
+        cv.copyTo(layers[label], (region == label).view(np.uint8), target)
+        
+    # return the combined image
+    return image_compose
+
+def _point_labels(shape, scale, rng):
+    """
+    The _point_labels function paints the region labels of the point generators, a randomized ellipse within a slightly larger blending ellipse.
+    
+    :param shape: the image height and width
+    :type shape: tuple
+    
+    :param scale: the ellipse scale relative to the image size, randomized if unspecified
+    :type scale: float
+    
+    :param rng: the random generator for the geometry
+    :type rng: numpy Generator
+    
+    :return: the region labels (0 background, 1 spot, 2 blend) and the blending ellipse's bounding box padded by the blur reach
+    :rtype: tuple
+    """
+    
     # image dimensions
-    hh, ww = image.shape[:2]
+    hh, ww = shape
+    
+    # draw the default scales and the angle in a single call
+    draw_x, draw_y, angle = rng.integers([5, 5, 0], [36, 36, 361]).tolist()
     
     # if scale not specified use randomized defaults
     if scale == None:
-        scale_x = .01*random.randint(5,35)
-        scale_y = .01*random.randint(5,35)
+        scale_x = .01*draw_x
+        scale_y = .01*draw_y
+    else:
+        scale_x = scale_y = scale
     
     # define elliptical blobs
-    radius_x = int(np.floor(scale_x*np.minimum(hh,ww)))
-    radius_y = int(np.floor(scale_y*np.minimum(hh,ww)))
+    radius_x = int(scale_x*min(hh, ww))
+    radius_y = int(scale_y*min(hh, ww))
     axes = (radius_x, radius_y)
-    angle = random.randint(0,360)
     
     # blending blob
     radius_blend_x = int(radius_x*1.05)
     radius_blend_y = int(radius_y*1.05)
     axes_blend = (radius_blend_x, radius_blend_y)
     
-    # randomize the location
-    radius = np.maximum(radius_x, radius_y)
-    yc = random.randint(radius, hh - radius)
-    xc = random.randint(radius, ww - radius)
+    # randomize the location, both coordinates in a single call
+    radius = max(radius_x, radius_y)
+    yc, xc = rng.integers([radius, radius], [hh - radius + 1, ww - radius + 1]).tolist()
+    
+    # paint the blending ellipse first and the spot over it
+    labels = _label_buffer(shape)
+    cv.ellipse(labels, (xc,yc), axes_blend, angle, 0, 360, 2, -1, cv.LINE_8)
+    cv.ellipse(labels, (xc,yc), axes, angle, 0, 360, 1, -1, cv.LINE_8)
+
+    # return the labels and the region the spot and its blur show in
+    return labels, _region_of_interest(labels, _BLUR_RADIUS)
+
+def _streak_labels(shape, role, rng, streak_angle = None):
+    """
+    The _streak_labels function paints the region labels of the streak generators, a slice from the top of the image blended on its far side from the effect.
+    
+    :param shape: the image height and width
+    :type shape: tuple
+    
+    :param role: 'source' to blend below the slice, 'shadow' to blend above it
+    :type role: string
+    
+    :param rng: the random generator for the geometry
+    :type rng: numpy Generator
+    
+    :param streak_angle: the angle at which to slice the image
+    :type streak_angle: integer, optional
+    
+    :return: the region labels (0 background, 1 streak, 2 blend) and the band of rows the blending slice spans padded by the blur reach
+    :rtype: tuple
+    """
+    
+    # slice the image, the source blends below the slice and the shadow above it
+    pts, pts_blend = _streak_geometry(shape[0], shape[1], rng, 1 if role == 'source' else -1, streak_angle)
     
-    # draw filled ellipses in white on black background as masks
-    mask = np.zeros_like(image)
-    overlay = cv.ellipse(mask, (xc,yc), axes, angle, 0, 360, (255,255,255), -1, cv.LINE_AA)
-    mask_blend = np.zeros_like(image)
-    mask_blend = cv.ellipse(mask_blend, (xc,yc), axes_blend, angle, 0, 360, (255,255,255), -1, cv.LINE_AA)
+    # paint the larger slice as blend first and the smaller one over it, aliased so the regions stay disjoint
+    outer, inner = (pts_blend, pts) if role == 'source' else (pts, pts_blend)
+    labels = _label_buffer(shape)
+    cv.drawContours(labels, [outer], -1, 2, -1, cv.LINE_8)
+    cv.drawContours(labels, [inner], -1, 1, -1, cv.LINE_8)
     
-    # subtract masks and make into single channel
-    mask = cv.subtract(mask_blend, mask)
-    background = cv.bitwise_not(mask_blend)
+    # return the labels and the band the blur shows in, between the lowest and highest cut
+    cuts = np.concatenate((pts[2:, 1], pts_blend[2:, 1]))
+    return labels, _rows_of_interest(cuts.min(), cuts.max(), shape, _BLUR_RADIUS + 1)
 
-    # apply the exposure effects to the image
-    blend = poor_focus(over_expose(image, environment_flag = True), 2)
-    img_over =  over_expose(image, environment_flag = True)
-    img_under =  dark_noise(under_expose(image, environment_flag = True), var = .001, cv_image = True, IR = IR)
+def _pipe_labels(shape, rng, pipe_angle = None):
+    """
+    The _pipe_labels function paints the region labels of the pipe generators, a pipe across the image blended on both its outer sides.
+    
+    :param shape: the image height and width
+    :type shape: tuple
+    
+    :param rng: the random generator for the geometry
+    :type rng: numpy Generator
+    
+    :param pipe_angle: the angle at which to create the image pipe
+    :type pipe_angle: integer, optional
+    
+    :return: the region labels (0 background, 1 pipe, 2 blend) and the band of rows the blending strips span padded by the blur reach
+    :rtype: tuple
+    """
+    
+    # generate the pipe, its outer strips and their unblended parts
+    pts, pts_top, pts_bottom, pts_blend_top, pts_blend_bottom = _pipe_geometry(shape[0], shape[1], rng, pipe_angle)
+        
+    # the pipe goes first, then each outer strip as blend with its unblended part cleared back to background, aliased so the regions stay disjoint
+    labels = _label_buffer(shape)
+    cv.drawContours(labels, [pts], -1, 1, -1, cv.LINE_8)
+    cv.drawContours(labels, [pts_top, pts_bottom], -1, 2, -1, cv.LINE_8)
+    cv.drawContours(labels, [pts_blend_top, pts_blend_bottom], -1, 0, -1, cv.LINE_8)
+    
+    # return the labels and the band the blur shows in, from the top strip's blending edge to the bottom one's
+    return labels, _rows_of_interest(pts_blend_top[2:, 1].min(), pts_blend_bottom[:2, 1].max(), shape, _BLUR_RADIUS + 1)
+
+def _environment_effect(image, labels, role, IR, variants = None, spot_roi = None, blend_roi = None):
+    """
+    The _environment_effect function applies the exposure effects of a source or a shadow to the image by region, shared by all the environment generators.
+    A source over-exposes the labelled region and under-exposes the background with dark noise, a shadow under-exposes the region with dark noise and over-exposes the background with shot noise.
+    
+    :param image: the image to be noise-augmented
+    :type image: numpy array
+    
+    :param labels: the region labels (0 background, 1 effect region, 2 blend)
+    :type labels: numpy array
+    
+    :param role: 'source' or 'shadow'
+    :type role: string
+    
+    :param IR: flag to indicate whether infrared image or not
+    :type IR: boolean
     
-    # mask the effects appropriately
-    blend = cv.bitwise_and(blend, mask)
-    spot = cv.bitwise_and(img_over, overlay)
-    bg = cv.bitwise_and(img_under, background)
+    :param variants: precomputed exposure variants, see environment_layers or precompute_env_variants
+    :type variants: dictionary, optional
     
-    # combine the masked effects back into a full image
-    image_point_source = bg + spot + blend
+    :param spot_roi: the (x, y, width, height) region the effect region shows in, the whole image if unspecified
+    :type spot_roi: tuple, optional
+    
+    :param blend_roi: the (x, y, width, height) region the blend shows in, the whole image if unspecified
+    :type blend_roi: tuple, optional
+    
+    :return: the noise-augmented image
+    :rtype: numpy array
+    """
+    
+    # apply the exposure effects to the image, reusing any precomputed variants
+    # the spot exposure is requested before the blend, so a full-frame exposure is computed once and the blend band slices it
+    # the dark noise comes from the shared tiles on full-frame layers only, a region's size changes every call and is cheap to draw afresh
+    variants = dict(variants) if variants != None else {}
+    if role == 'source':
+        img_spot = _variant(variants, image, 'over', spot_roi)
+        img_blend = _variant(variants, image, 'over_blur', blend_roi)
+        img_background = dark_noise(_variant(variants, image, 'under'), var = .001, cv_image = True, IR = IR, pooled = True)
+    else:
+        img_under = _variant(variants, image, 'under', spot_roi)
+        img_blend = _variant(variants, image, 'under_blur', blend_roi)
+        img_background = shot_noise(_variant(variants, image, 'over'), cv_image = True, IR = IR)
+        img_spot = dark_noise(img_under, var = .01, cv_image = True, IR = IR, pooled = spot_roi is None)
+    
+    # the infrared noise stores a single channel input as BGR, so bring the noiseless layers to the same layout
+    if img_spot.ndim < img_background.ndim: img_spot = cv.cvtColor(img_spot, cv.COLOR_GRAY2BGR)
+    if img_blend.ndim < img_background.ndim: img_blend = cv.cvtColor(img_blend, cv.COLOR_GRAY2BGR)
+    
+    # combine the effects into a full image by region
+    image_effect = _compose(labels, [img_background, img_spot, img_blend], [spot_roi, blend_roi])
+    
+    # return the noise-augmented image
+    return image_effect
+
+def point_source(image, scale = None, IR = True, variants = None, rng = None):
+    """
+    The point_source function models specular point sources.
+    This is done with modelling randomized ellipses, which are over-exposed, under-exposing the background and blending the boundary.
+    By default, it assumes a randomized ellipse size between .05 and .035 with random placement. These can alternatively be specified.
+    
+    :param image: the image to be noise-augmented
+    :type image: numpy array
+    
+    :param scale: the ellipse scale relative to the image size
+    :type scale: float, optional
+    
+    :param IR: flag to indicate whether infrared image or not
+    :type IR: boolean, optional
+    
+    :param variants: precomputed exposure variants, see environment_layers or precompute_env_variants
+    :type variants: dictionary, optional
+    
+    :param rng: the random generator for the geometry, the shared noise generator if unspecified
+    :type rng: numpy Generator, optional
+    
+    :return: the noise-augmented image
+    :rtype: numpy array
+    """
+    
+    # draw the geometry from the shared noise generator unless one is given
+    if rng == None: rng = noise_generator()
+    
+    # paint the spot and blending ellipse, the spot and its blur are only computed on the region they show in
+    labels, roi = _point_labels(image.shape[:2], scale, rng)
+    
+    # apply the exposure effects by region, reusing any precomputed variants
+    image_point_source = _environment_effect(image, labels, 'source', IR, variants, roi, roi)
     
     # return noise-augmented image
     return image_point_source
 
-def point_shadow(image, scale = None, randomize = True, IR = True):
+def point_shadow(image, scale = None, randomize = True, IR = True, variants = None, rng = None):
     """
     The point_shadow function models a single obstruction presenting an elliptical shadow.
     This is done with modelling randomized ellipses, which are under-exposed, over-exposing the background and blending the boundary.
@@ -105,62 +565,30 @@ def point_shadow(image, scale = None, randomize = True, IR = True):
     :param IR: flag to indicate whether infrared image or not
     :type IR: boolean, optional
     
+    :param variants: precomputed exposure variants, see environment_layers or precompute_env_variants
+    :type variants: dictionary, optional
+    
+    :param rng: the random generator for the geometry, the shared noise generator if unspecified
+    :type rng: numpy Generator, optional
+    
     :return: the noise-augmented image
     :rtype: numpy array
     """
     
-    # image dimensions
-    hh, ww = image.shape[:2]
-    
-    # if scale not specified use randomized defaults
-    if scale == None:
-        scale_x = .01*random.randint(5,35)
-        scale_y = .01*random.randint(5,35)
+    # draw the geometry from the shared noise generator unless one is given
+    if rng == None: rng = noise_generator()
     
-    # define elliptical blobs
-    radius_x = int(np.floor(scale_x*np.minimum(hh,ww)))
-    radius_y = int(np.floor(scale_y*np.minimum(hh,ww)))
-    axes = (radius_x, radius_y)
-    angle = random.randint(0,360)
-    
-    # blending blob
-    radius_blend_x = int(radius_x*1.05)
-    radius_blend_y = int(radius_y*1.05)
-    axes_blend = (radius_blend_x, radius_blend_y)
+    # paint the shadow and blending ellipse, the shadow and its blur are only computed on the region they show in
+    labels, roi = _point_labels(image.shape[:2], scale, rng)
     
-    # randomize the location
-    radius = np.maximum(radius_x, radius_y)
-    yc = random.randint(radius, hh - radius)
-    xc = random.randint(radius, ww - radius)
-    
-    # draw filled ellipses in white on black background as masks
-    mask = np.zeros_like(image)
-    overlay = cv.ellipse(mask, (xc,yc), axes, angle, 0, 360, (255,255,255), -1, cv.LINE_AA)
-    mask_blend = np.zeros_like(image)
-    mask_blend = cv.ellipse(mask_blend, (xc,yc), axes_blend, angle, 0, 360, (255,255,255), -1, cv.LINE_AA)
-    
-    # subtract masks and make into single channel
-    mask = cv.subtract(mask_blend, mask)
-    background = cv.bitwise_not(mask_blend)
-
-    # apply the exposure effects to the image
-    blend = poor_focus(under_expose(image, environment_flag = True), 2)
-    img_over =  shot_noise(over_expose(image, environment_flag = True), cv_image = True, IR = IR)
-    img_under =  dark_noise(under_expose(image, environment_flag = True), var = .01, cv_image = True, IR = IR)
-   
-    # mask the effects appropriately
-    blend = cv.bitwise_and(blend, mask)
-    spot = cv.bitwise_and(img_under, overlay)
-    bg = cv.bitwise_and(img_over, background)
-    
-    # combine the masked effects back into a full image
-    image_point_shadow = bg + spot + blend
+    # apply the exposure effects by region, reusing any precomputed variants
+    image_point_shadow = _environment_effect(image, labels, 'shadow', IR, variants, roi, roi)
     
     # return noise-augmented image
     return image_point_shadow
 
 
-def streak_source(image, streak_angle = None, IR = True):
+def streak_source(image, streak_angle = None, IR = True, variants = None, rng = None):
     """
     The streak_source function models an overhead source that presents as a bright streak across the image.
     This is done with modelling randomized overhead sun angles to slice the image, over-exposing the top, under-exposing the bottom and blending the boundary.
@@ -175,67 +603,29 @@ def streak_source(image, streak_angle = None, IR = True):
     :param IR: flag to indicate whether infrared image or not
     :type IR: boolean, optional
     
+    :param variants: precomputed exposure variants, see environment_layers or precompute_env_variants
+    :type variants: dictionary, optional
+    
+    :param rng: the random generator for the geometry, the shared noise generator if unspecified
+    :type rng: numpy Generator, optional
+    
     :return: the noise-augmented image
     :rtype: numpy array
     """
-        
-    # image dimensions
-    hh, ww = image.shape[:2]
-    
-    # if no angle is specified, randomly generate the slice
-    if streak_angle == None:    
-        top_left = [0, 0]
-        top_right = [ww, 0]
-        left_cut = random.randint(int(1*hh/4), int(3*hh/4))
-        right_cut = random.randint(int(1*hh/4), int(3*hh/4))
-        bottom_left = [0, left_cut]
-        bottom_right = [ww, right_cut]
-        
-    # otherwise calculate the specified slice
-    else:
-        
-        # enforce streak to be overhead
-        assert(streak_angle > 0 and streak_angle < 180)
-        raise ValueError('Function to come')
-    
-    # generate the slice
-    pts = np.array([top_left, top_right, bottom_right, bottom_left])
-    
-    # blend crop geometries
-    blend_slice = .01*np.minimum(hh, ww)
-    blend_left = [0, int(left_cut + blend_slice)]
-    blend_right = [ww, int(right_cut + blend_slice)]
-    pts_blend = np.array([top_left, top_right, blend_right, blend_left])
-    
-    # make mask
-    mask = np.zeros_like(image)
-    overlay = cv.drawContours(mask, [pts], -1, (255, 255, 255), -1, cv.LINE_AA)
     
-    # make blending masks
-    mask_blend = np.zeros_like(image)
-    blend = cv.drawContours(mask_blend, [pts_blend], -1, (255, 255, 255), -1, cv.LINE_AA)
-
-    # subtract masks and make into single channel
-    blend = cv.bitwise_xor(mask_blend, mask)
-    background = cv.bitwise_not(cv.bitwise_or(mask, mask_blend))
-    
-    # apply the exposure effects to the image
-    img_blur = poor_focus(over_expose(image, environment_flag = True), 2)
-    img_over =  over_expose(image, environment_flag = True)
-    img_under =  dark_noise(under_expose(image, environment_flag = True), var = .001, cv_image = True, IR = IR)
+    # draw the geometry from the shared noise generator unless one is given
+    if rng == None: rng = noise_generator()
     
-    # mask the effects appropriately
-    blend = cv.bitwise_and(img_blur, blend)
-    streak = cv.bitwise_and(img_over, overlay)
-    bg = cv.bitwise_and(img_under, background)
+    # slice the image, blending below the slice, the blur is only computed on the band it shows in
+    labels, roi = _streak_labels(image.shape[:2], 'source', rng, streak_angle)
     
-    # combine the masked effects back into a full image
-    image_streak_source = bg + streak + blend
+    # apply the exposure effects by region, reusing any precomputed variants
+    image_streak_source = _environment_effect(image, labels, 'source', IR, variants, blend_roi = roi)
     
     # return noise-augmented image
     return image_streak_source
 
-def streak_shadow(image, streak_angle = None, IR = True):
+def streak_shadow(image, streak_angle = None, IR = True, variants = None, rng = None):
     """
     The streak_shadow function models a below horizon source that illuminates the bottom of the image, effectively shadowing the top.
     This is done with modelling randomized overhead sun angles to slice the image, under-exposing the top, over-exposing the bottom and blending the boundary.
@@ -250,64 +640,29 @@ def streak_shadow(image, streak_angle = None, IR = True):
     :param IR: flag to indicate whether infrared image or not
     :type IR: boolean, optional
     
+    :param variants: precomputed exposure variants, see environment_layers or precompute_env_variants
+    :type variants: dictionary, optional
+    
+    :param rng: the random generator for the geometry, the shared noise generator if unspecified
+    :type rng: numpy Generator, optional
+    
     :return: the noise-augmented image
     :rtype: numpy array
     """
-        
-    # image dimensions
-    hh, ww = image.shape[:2]
     
-    # if no angle is specified, randomly generate the slice
-    if streak_angle == None:    
-        top_left = [0, 0]
-        top_right = [ww, 0]
-        left_cut = random.randint(int(1*hh/4), int(3*hh/4))
-        right_cut = random.randint(int(1*hh/4), int(3*hh/4))
-        bottom_left = [0, left_cut]
-        bottom_right = [ww, right_cut]
-        
-    # otherwise calculate the specified slice
-    else:
-        
-        # enforce streak to be overhead
-        assert(streak_angle > 0 and streak_angle < 180)
-        raise ValueError('Function to come')
+    # draw the geometry from the shared noise generator unless one is given
+    if rng == None: rng = noise_generator()
     
-    # blend crop geometries
-    blend_slice = .01*np.minimum(hh, ww)
-    blend_left = [0, int(left_cut - blend_slice)]
-    blend_right = [ww, int(right_cut - blend_slice)]
-    pts_blend = np.array([top_left, top_right, blend_right, blend_left])
+    # slice the image, blending above the slice, the blur is only computed on the band it shows in
+    labels, roi = _streak_labels(image.shape[:2], 'shadow', rng, streak_angle)
     
-    # make mask
-    mask = np.zeros_like(image)
-    overlay = cv.drawContours(mask, [pts], -1, (255, 255, 255), -1, cv.LINE_AA)
-    
-    # make blending mask
-    mask_blend = np.zeros_like(image)
-    blend = cv.drawContours(mask_blend, [pts_blend], -1, (255, 255, 255), -1, cv.LINE_AA)
-
-    # subtract masks and make into single channel
-    blend = cv.bitwise_xor(mask, mask_blend)
-    background = cv.bitwise_not(cv.bitwise_or(mask, mask_blend))
-        
-    # apply the exposure effects to the image
-    img_blur = poor_focus(under_expose(image, environment_flag = True), 2)
-    img_over =  shot_noise(over_expose(image, environment_flag = True), cv_image = True, IR = IR)
-    img_under =  dark_noise(under_expose(image, environment_flag = True), var = .01, cv_image = True, IR = IR)
-
-    # mask the effects appropriately
-    blend = cv.bitwise_and(img_blur, blend)
-    streak = cv.bitwise_and(img_under, overlay)
-    bg = cv.bitwise_and(img_over, background)
-    
-    # combine the masked effects back into a full image
-    image_streak_shadow = bg + streak + blend
+    # apply the exposure effects by region, reusing any precomputed variants
+    image_streak_shadow = _environment_effect(image, labels, 'shadow', IR, variants, blend_roi = roi)
     
     # return the noise-augmented image
     return image_streak_shadow
 
-def pipe_source(image, pipe_angle = None, IR = True):
+def pipe_source(image, pipe_angle = None, IR = True, variants = None, rng = None):
     """
     The pipe_source function models an adjacent light source that presents as an illuminated pipe across the image.
     This is done with modelling randomized adjacent sun angles to create a pipe across the image, over-exposing the pipe, under-exposing the background and blending the boundaries.
@@ -322,88 +677,31 @@ def pipe_source(image, pipe_angle = None, IR = True):
     :param IR: flag to indicate whether infrared image or not
     :type IR: boolean, optional
     
+    :param variants: precomputed exposure variants, see environment_layers or precompute_env_variants
+    :type variants: dictionary, optional
+    
+    :param rng: the random generator for the geometry, the shared noise generator if unspecified
+    :type rng: numpy Generator, optional
+    
     :return: the noise-augmented image
     :rtype: numpy array
     """
-        
-    # image dimensions
-    hh, ww = image.shape[:2]
     
-    # if no angle specified, randomly generate the pipe geometry
-    if pipe_angle == None:
-        top_left_cut = random.randint(int(.1*hh), int(hh/3))
-        top_right_cut = random.randint(int(.1*hh), int(hh/3))
-        bottom_left_cut = random.randint(int(hh/2*1.1), int(2/3*hh))
-        bottom_right_cut = random.randint(int(hh/2*1.1), int(2/3*hh))
-
-        top_left = [0, top_left_cut]
-        top_right = [ww, top_right_cut]
-        bottom_left = [0, bottom_left_cut]
-        bottom_right = [ww, bottom_right_cut]
-        
-    # otherwise calculate the specified pipe
-    else:
-        
-        # enforce streak to be overhead
-        assert(pipe_angle > 0 and pipe_angle < 180)
-        raise ValueError('Function to come')        
+    # draw the geometry from the shared noise generator unless one is given
+    if rng == None: rng = noise_generator()
     
-    # generate the pipe boundaries
-    pts = np.array([top_left, top_right, bottom_right, bottom_left])
-    pts_top = np.array([[0,0], [ww, 0], top_right, top_left])
-    pts_bottom = np.array([bottom_left, bottom_right, [ww, hh], [0,hh]])
-
-    # determine the crop blending points
-    blend_slice = .01*np.minimum(hh, ww)
-    blend_top_left = [0, int(top_left_cut - blend_slice)]
-    blend_top_right = [ww, int(top_right_cut - blend_slice)]
-    blend_bottom_left = [0, int(bottom_left_cut + blend_slice)]
-    blend_bottom_right = [ww, int(bottom_right_cut + blend_slice)]
+    # generate the pipe, blending its outer sides, the blur is only computed on the band it shows in
+    labels, roi = _pipe_labels(image.shape[:2], rng, pipe_angle)
     
-    # generate the blending boundaries
-    pts_blend_top = np.array([[0,0], [ww,0], blend_top_right, blend_top_left])
-    pts_blend_bottom = np.array([blend_bottom_left, blend_bottom_right, [ww, hh], [0,hh]])
-        
-    # make mask
-    mask = np.zeros_like(image)
-    overlay = cv.drawContours(mask, [pts], -1, (255, 255, 255), -1, cv.LINE_AA)
-    
-    # make blending masks
-    mask_top = np.zeros_like(image)
-    overlay_top = cv.drawContours(mask_top, [pts_top], -1, (255, 255, 255), -1, cv.LINE_AA)
-    mask_bottom = np.zeros_like(image)
-    overlay_bottom = cv.drawContours(mask_bottom, [pts_bottom], -1, (255, 255, 255), -1, cv.LINE_AA)
-    mask_blend_top = np.zeros_like(image)
-    blend_top = cv.drawContours(mask_blend_top, [pts_blend_top], -1, (255, 255, 255), -1, cv.LINE_AA)
-    mask_blend_bottom = np.zeros_like(image)
-    blend_bottom = cv.drawContours(mask_blend_bottom, [pts_blend_bottom], -1, (255, 255, 255), -1, cv.LINE_AA)
-    
-    # subtract masks and make into single channel
-    blend_top = cv.bitwise_xor(mask_top, mask_blend_top)
-    blend_bottom = cv.bitwise_xor(overlay_bottom, blend_bottom)
-    total = cv.bitwise_or(cv.bitwise_or(blend_top, blend_bottom), mask)
-    background = cv.bitwise_not(total)
-    
-    # apply the exposure effects to the image
-    img_blur = poor_focus(over_expose(image, environment_flag = True), 2)
-    img_over =  over_expose(image, environment_flag = True)
-    img_under =  dark_noise(under_expose(image, environment_flag = True), var = .001, cv_image = True, IR = IR)
-
-    # mask the effects appropriately
-    blend_top = cv.bitwise_and(img_blur, blend_top)
-    blend_bottom = cv.bitwise_and(img_blur, blend_bottom)
-    streak = cv.bitwise_and(img_over, overlay)
-    bg = cv.bitwise_and(img_under, background)
-    
-    # combine the masked effects back into a full image
-    image_pipe_light = bg + streak +  blend_top + blend_bottom
+    # apply the exposure effects by region, reusing any precomputed variants
+    image_pipe_light = _environment_effect(image, labels, 'source', IR, variants, blend_roi = roi)
     
     # return the noise-augmented image
     return image_pipe_light
 
 
-def pipe_shadow(image, randomize = True, IR = True):
-     """
+def pipe_shadow(image, pipe_angle = None, IR = True, variants = None, rng = None):
+    """
     The pipe_shadow function models an adjacent obstruction that presents as an shadow pipe across the image.
     This is done with modelling randomized adjacent sun angles to create a pipe across the image, under-exposing the pipe, over-exposing the background and blending the boundaries.
     By default, it assumes a slice between 1/4 to 3/4 of the image height randomly selected on both sides. This can alterantively be specified with an angle (to come).
@@ -417,82 +715,103 @@ def pipe_shadow(image, randomize = True, IR = True):
     :param IR: flag to indicate whether infrared image or not
     :type IR: boolean, optional
     
+    :param variants: precomputed exposure variants, see environment_layers or precompute_env_variants
+    :type variants: dictionary, optional
+    
+    :param rng: the random generator for the geometry, the shared noise generator if unspecified
+    :type rng: numpy Generator, optional
+    
     :return: the noise-augmented image
     :rtype: numpy array
     """
-        
-    # image dimensions
-    hh, ww = image.shape[:2]
     
+    # draw the geometry from the shared noise generator unless one is given
+    if rng == None: rng = noise_generator()
+    
+    # generate the pipe, blending its outer sides, the blur is only computed on the band it shows in
+    labels, roi = _pipe_labels(image.shape[:2], rng, pipe_angle)
+    
+    # apply the exposure effects by region, reusing any precomputed variants
+    image_pipe_shadow = _environment_effect(image, labels, 'shadow', IR, variants, blend_roi = roi)
+    
+    # return the noise-augmented image
+    return image_pipe_shadow
 
-    # if no angle specified, randomly generate the pipe geometry
-    if pipe_angle == None:
-        top_left_cut = random.randint(int(.1*hh), int(hh/3))
-        top_right_cut = random.randint(int(.1*hh), int(hh/3))
-        bottom_left_cut = random.randint(int(hh/2*1.1), int(2/3*hh))
-        bottom_right_cut = random.randint(int(hh/2*1.1), int(2/3*hh))
 
-        top_left = [0, top_left_cut]
-        top_right = [ww, top_right_cut]
-        bottom_left = [0, bottom_left_cut]
-        bottom_right = [ww, bottom_right_cut]
-        
-    # otherwise calculate the specified pipe
-    else:
+# worker pool shared by apply_batch calls, spawned on first use and reused until the worker count changes
+_batch_pool = None
+_batch_workers = None
+
+def _shared_batch_pool(workers):
+    """
+    The _shared_batch_pool function returns the process pool shared by apply_batch calls, spawning it on first use.
+    Spawning workers re-imports opencv and skimage in each of them, so the pool is kept alive across batches rather than created per call.
+    
+    :param workers: the number of worker processes
+    :type workers: integer
+    
+    :return: the shared pool
+    :rtype: multiprocessing Pool
+    """
+    
+    # replace the pool only on first use or a new worker count
+    global _batch_pool, _batch_workers
+    if _batch_pool == None or _batch_workers != workers:
+        if _batch_pool == None: atexit.register(_close_batch_pool)
+        else: _batch_pool.terminate()
+        _batch_pool = mp.get_context('spawn').Pool(workers, initializer=init_pool_worker)
+        _batch_workers = workers
         
-        # enforce streak to be overhead
-        assert(pipe_angle > 0 and pipe_angle < 180)
-        raise ValueError('Function to come')      
+    # return the shared pool
+    return _batch_pool
+
+def _close_batch_pool():
+    """
+    The _close_batch_pool function shuts down the shared apply_batch pool, it is registered to run at exit.
+    """
     
-    # generate the pipe boundaries
-    pts = np.array([top_left, top_right, bottom_right, bottom_left])
-    pts_top = np.array([[0,0], [ww, 0], top_right, top_left])
-    pts_bottom = np.array([bottom_left, bottom_right, [ww, hh], [0,hh]])
+    # stop the workers if the pool was ever started
+    global _batch_pool
+    if _batch_pool != None:
+        _batch_pool.terminate()
+        _batch_pool = None
 
-    # determine the crop blending points
-    blend_slice = .01*np.minimum(hh, ww)
-    blend_top_left = [0, int(top_left_cut - blend_slice)]
-    blend_top_right = [ww, int(top_right_cut - blend_slice)]
-    blend_bottom_left = [0, int(bottom_left_cut + blend_slice)]
-    blend_bottom_right = [ww, int(bottom_right_cut + blend_slice)]
+def apply_batch(func, images, workers = None, chunksize = 8, pool = None, **kwargs):
+    """
+    The apply_batch function applies a noise generator to a batch of in-memory images across a process pool, one image per task end to end.
+    Intended for data loaders that augment a batch at a time, e.g. apply_batch(point_source, batch, IR = False); for images on disk see run_batch in noise_generators_camera.py.
+    The workers are spawned on the first call and reused by later ones, pass your own pool to control its lifetime, a single worker runs inline.
     
-    # generate the blending boundaries
-    pts_blend_top = np.array([[0,0], [ww,0], blend_top_right, blend_top_left])
-    pts_blend_bottom = np.array([blend_bottom_left, blend_bottom_right, [ww, hh], [0,hh]])
-        
-    # make mask
-    mask = np.zeros_like(image)
-    overlay = cv.drawContours(mask, [pts], -1, (255, 255, 255), -1, cv.LINE_AA)
-    
-    # make blending masks
-    mask_top = np.zeros_like(image)
-    overlay_top = cv.drawContours(mask_top, [pts_top], -1, (255, 255, 255), -1, cv.LINE_AA)
-    mask_bottom = np.zeros_like(image)
-    overlay_bottom = cv.drawContours(mask_bottom, [pts_bottom], -1, (255, 255, 255), -1, cv.LINE_AA)
-    mask_blend_top = np.zeros_like(image)
-    blend_top = cv.drawContours(mask_blend_top, [pts_blend_top], -1, (255, 255, 255), -1, cv.LINE_AA)
-    mask_blend_bottom = np.zeros_like(image)
-    blend_bottom = cv.drawContours(mask_blend_bottom, [pts_blend_bottom], -1, (255, 255, 255), -1, cv.LINE_AA)
-    
-    # subtract masks and make into single channel
-    blend_top = cv.bitwise_xor(mask_top, mask_blend_top)
-    blend_bottom = cv.bitwise_xor(overlay_bottom, blend_bottom)
-    total = cv.bitwise_or(cv.bitwise_or(blend_top, blend_bottom), mask)
-    background = cv.bitwise_not(total)
-    
-    # apply the exposure effects to the image
-    img_blur = poor_focus(under_expose(image, environment_flag = True), 2)
-    img_over =  shot_noise(over_expose(image, environment_flag = True), cv_image = True, IR = IR)
-    img_under =  dark_noise(under_expose(image, environment_flag = True), var = .01, cv_image = True, IR = IR)
-
-    # mask the effects appropriately
-    blend_top = cv.bitwise_and(img_blur, blend_top)
-    blend_bottom = cv.bitwise_and(img_blur, blend_bottom)
-    streak = cv.bitwise_and(img_under, overlay)
-    bg = cv.bitwise_and(img_over, background)
-    
-    # combine the masked effects back into a full image
-    image_pipe_shadow = bg + streak +  blend_top + blend_bottom
+    :param func: the noise augmentation function, it must be defined at module level to be sent to the workers
+    :type func: function pointer
     
-    # return the noise-augmented image
-    return image_pipe_shadow
+    :param images: the images to be noise-augmented
+    :type images: list
+    
+    :param workers: the number of worker processes, all cores by default
+    :type workers: integer, optional
+    
+    :param chunksize: the number of images sent to a worker at a time
+    :type chunksize: integer, optional
+    
+    :param pool: a caller-owned process pool, ideally spawned with init_pool_worker as its initializer, the shared pool if unspecified
+    :type pool: multiprocessing Pool, optional
+    
+    :param kwargs: the keyword arguments forwarded to the noise function
+    :type kwargs: dictionary, optional
+    
+    :return: the noise-augmented images, in the input order
+    :rtype: list
+    """
+    
+    # a single worker gains nothing from a pool, so run the batch inline
+    if workers == None: workers = os.cpu_count() or 1
+    if pool == None and workers == 1:
+        return [func(image, **kwargs) for image in images]
+    
+    # otherwise map over the given or shared pool, results keep the input order
+    if pool == None: pool = _shared_batch_pool(workers)
+    image_batch = list(pool.imap(partial(func, **kwargs), images, chunksize=chunksize))
+    
+    # return the noise-augmented images
+    return image_batch